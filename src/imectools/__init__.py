@@ -1,14 +1,41 @@
 """Tools for the core formerly known as the Nikon Imaging Center at HMS."""
 
-from importlib.metadata import PackageNotFoundError, version
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    __version__: str
 
-try:
-    __version__ = version("imectools")
-except PackageNotFoundError:
-    __version__ = "uninstalled"
 __author__ = "Talley Lambert"
 __email__ = "talley.lambert@example.com"
 
-from ._cleanup import iter_empty_dirs, iter_old_files
+from ._cleanup import (
+    TreeCache,
+    iter_empty_dirs,
+    iter_old_files,
+    load_tree_cache,
+    save_tree_cache,
+)
+
+__all__ = [
+    "TreeCache",
+    "iter_empty_dirs",
+    "iter_old_files",
+    "load_tree_cache",
+    "save_tree_cache",
+    "__version__",
+]
+
+
+def __getattr__(name: str) -> Any:
+    # look up the version lazily: reading package metadata is slow-ish, and most
+    # invocations of the CLI never need it.
+    if name == "__version__":
+        from importlib.metadata import PackageNotFoundError, version
 
-__all__ = ["iter_empty_dirs", "iter_old_files", "__version__"]
+        try:
+            __version__ = version("imectools")
+        except PackageNotFoundError:
+            __version__ = "uninstalled"
+        globals()["__version__"] = __version__
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,47 +1,358 @@
+import os
+import stat
 import time
-from pathlib import Path
-from typing import Iterator, Tuple, Union
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+    from pathlib import Path
 
 SEC_PER_DAY = 60 * 60 * 24
 TIME = time.time()
+STAT_BATCH = 4096
+# extra days a directory must be past the cutoff before its files' ages are
+# inferred from the directory, rather than stat-ed individually
+QUIESCENT_MARGIN = 1
+
+
+# substring (or predicate) matched against entry names to exclude them from cleanup
+Skip = Union[str, Callable[[str], bool]]
+# (name, timestamp) for each entry in a directory.  timestamp is the most recent of
+# mtime and ctime for regular files, and None for anything else (or if unknown).
+Listing = List[Tuple[str, Optional[float]]]
+
+
+class TreeCache:
+    """Metadata collected while walking a directory tree.
+
+    Passing the same cache to `iter_old_files` and then `iter_empty_dirs` lets the
+    second pass reuse the first traversal instead of walking (and stat-ing) the
+    tree again.  Only per-directory information is kept, unless `listings` is given:
+    then the contents of each directory are recorded as well, so that they may be
+    persisted between runs with `save_tree_cache` and `load_tree_cache`, and
+    directories whose mtime has not changed are not listed again.
+
+    Attributes
+    ----------
+    dirs : Set[str]
+        Paths of all (non-skipped) directories below the root that were visited.
+    n_entries : Dict[str, int]
+        Number of entries (including skipped ones) remaining in each directory that
+        was listed, by path.  See `mark_removed`.
+    listings : Optional[Dict[str, Tuple[float, Listing]]]
+        mtime and contents of each directory that was listed, by path relative
+        to the root of the walk.  None if listings are not being recorded.
+    """
+
+    def __init__(
+        self, listings: Optional[Dict[str, Tuple[float, Listing]]] = None
+    ) -> None:
+        self.dirs: Set[str] = set()
+        self.n_entries: Dict[str, int] = {}
+        self.listings = listings
+
+    def mark_removed(self, path: Union[str, "Path"]) -> None:
+        """Record that `path` (found during the walk) has since been removed."""
+        parent = os.path.dirname(os.fspath(path))
+        if parent in self.n_entries:
+            self.n_entries[parent] -= 1
+
+
+def load_tree_cache(path: Union[str, "Path"]) -> TreeCache:
+    """Load directory listings saved by `save_tree_cache`.
+
+    The returned cache records listings (see `TreeCache`).  They are empty if `path`
+    does not exist or cannot be read.
+    """
+    import pickle
+
+    try:
+        with open(path, "rb") as f:
+            listings = pickle.load(f)
+    except Exception:
+        listings = None
+    return TreeCache(listings=listings if isinstance(listings, dict) else {})
+
+
+def save_tree_cache(cache: TreeCache, path: Union[str, "Path"]) -> None:
+    """Save the directory listings in `cache` to `path`."""
+    import pickle
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump(cache.listings or {}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _timestamp(st: os.stat_result) -> float:
+    return max(st.st_mtime, st.st_ctime)
+
+
+def _age(timestamp: float) -> float:
+    """Days since `timestamp`."""
+    return (TIME - timestamp) / SEC_PER_DAY
+
+
+def _skip_func(skip: Skip) -> Optional[Callable[[str], bool]]:
+    """Return a predicate on entry names for `skip` (None if nothing is skipped)."""
+    if callable(skip):
+        return skip
+    if not skip:
+        return None
+    needle = skip.casefold()
+    return lambda name: needle in name.casefold()
+
+
+# (parent key, name, path, DirEntry if freshly listed, cached timestamp)
+_Listed = Tuple[str, str, str, Optional[os.DirEntry], Optional[float]]
+# (parent key, name, path, DirEntry if freshly listed, stat to use instead of lstat)
+_Item = Tuple[str, str, str, Optional[os.DirEntry], Optional[os.stat_result]]
+
+
+def _lstat(item: _Item) -> Optional[os.stat_result]:
+    *_, path, entry, st = item
+    if st is not None:
+        return st
+    try:
+        if entry is not None:
+            return entry.stat(follow_symlinks=False)
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _as_file_stat(dir_st: os.stat_result) -> os.stat_result:
+    """Return a regular-file stat result carrying the timestamps of `dir_st`."""
+    times = (dir_st.st_atime, dir_st.st_mtime, dir_st.st_ctime)
+    return os.stat_result((stat.S_IFREG, *tuple(dir_st)[1:7], *times))
+
+
+def _scan_tree(
+    directory: Union[str, "Path"],
+    skip: Skip = "",
+    cache: Optional[TreeCache] = None,
+    pool: Optional["Executor"] = None,
+    min_age: Optional[float] = None,
+    strict_mtime: bool = True,
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """Iterate over `(path, stat)` for entries nested in `directory`.
+
+    Entries whose name matches `skip` (see `iter_old_files`) are neither yielded nor
+    descended into.  If `cache` is provided, it is populated during the walk.
+
+    Entries are stat-ed in batches of up to `STAT_BATCH`.  If `pool` is provided,
+    the stat calls in each batch are run concurrently in that executor, which hides
+    most of the per-call latency on network shares.
+
+    If `cache` holds `listings` from a previous walk, directories whose mtime is
+    unchanged are not listed again.  Files that were no more than `min_age` days old
+    at the previous walk are neither stat-ed nor yielded (a file modified since then
+    can only have become younger).  Everything else is re-stat-ed, so a stale cache
+    never makes a file look older than it is.
+
+    If `strict_mtime` is False, regular files in a directory that has itself not
+    changed in more than `min_age + QUIESCENT_MARGIN` days are not stat-ed at all:
+    they are given the directory's timestamps instead.  (A file cannot have been
+    created in, or moved into, a directory more recently than the directory was
+    modified, but this does miss files whose *contents* changed in place, unless
+    the cached listing already recorded them as young.)
+    """
+    skipped = _skip_func(skip)
+    if cache is None:
+        cache = TreeCache()
+    listings = cache.listings
+    previous = dict(listings) if listings is not None else {}
+    _map = pool.map if pool is not None else map
+
+    # listings are only added to the cache once every entry in them has been seen,
+    # so that a walk that is stopped early never leaves an incomplete listing behind
+    pending: Dict[str, Tuple[float, Listing, int]] = {}
+    visited: Set[str] = set()
+
+    def _add(key: str, name: str, timestamp: Optional[float]) -> None:
+        if listings is None:
+            return
+        mtime, listing, n = pending[key]
+        listing.append((name, timestamp))
+        if len(listing) == n:
+            listings[key] = (mtime, listing)
+            del pending[key]
+
+    root = os.fspath(directory)
+    try:
+        root_st = os.stat(root)
+    except OSError:
+        return
+    stack: List[Tuple[str, os.stat_result]] = [(root, root_st)]
+    # entries waiting to be stat-ed (a single directory may hold more than a batch)
+    todo: Deque[_Item] = deque()
+    while stack or todo:
+        while stack and len(todo) < STAT_BATCH:
+            current, dir_st = stack.pop()
+            mtime = dir_st.st_mtime
+            key = os.path.relpath(current, root)
+            cached = previous.get(key)
+            if cached is not None and cached[0] == mtime:
+                items: List[_Listed] = [
+                    (key, name, os.path.join(current, name), None, ts)
+                    for name, ts in cached[1]
+                ]
+            else:
+                try:
+                    with os.scandir(current) as it:
+                        items = [(key, e.name, e.path, e, None) for e in it]
+                except OSError:
+                    continue
+            cache.n_entries[current] = len(items)
+            if listings is not None:
+                visited.add(key)
+                if items:
+                    pending[key] = (mtime, [], len(items))
+                else:
+                    listings[key] = (mtime, [])
+            quiescent = (
+                not strict_mtime
+                and min_age is not None
+                and _age(_timestamp(dir_st)) > min_age + QUIESCENT_MARGIN
+            )
+            for _, name, path, entry, ts in items:
+                if skipped is not None and skipped(name):
+                    _add(key, name, None)
+                    continue
+                # a real timestamp from the previous walk always beats one inferred
+                # from the directory: a file rewritten in place stays young
+                if ts is not None and min_age is not None and _age(ts) <= min_age:
+                    _add(key, name, ts)
+                    continue
+                if quiescent and (
+                    entry.is_file(follow_symlinks=False)
+                    if entry is not None
+                    else ts is not None
+                ):
+                    todo.append((key, name, path, None, _as_file_stat(dir_st)))
+                    continue
+                todo.append((key, name, path, entry, None))
+
+        batch = [todo.popleft() for _ in range(min(STAT_BATCH, len(todo)))]
+
+        for (key, name, path, *_), st in zip(batch, _map(_lstat, batch)):
+            if st is None:
+                _add(key, name, None)
+                continue
+            _add(key, name, _timestamp(st) if stat.S_ISREG(st.st_mode) else None)
+            if stat.S_ISDIR(st.st_mode):
+                cache.dirs.add(path)
+                stack.append((path, st))
+            yield path, st
+
+    # the whole tree was walked: forget directories that no longer exist
+    if listings is not None:
+        for key in previous.keys() - visited:
+            listings.pop(key, None)
 
 
 def iter_old_files(
-    directory: Union[str, Path], min_age: float = 30, skip: str = ""
-) -> Iterator[Tuple[Path, float]]:
+    directory: Union[str, "Path"],
+    min_age: float = 30,
+    skip: Skip = "",
+    cache: Optional[TreeCache] = None,
+    pool: Optional["Executor"] = None,
+    strict_mtime: bool = True,
+) -> Iterator[Tuple[str, float]]:
     """Iterate over files in `directory` that are greater than `min_age` days old.
 
     Parameters
     ----------
-    directory : Union[str, Path]
+    directory : Union[str, "Path"]
         Some directory to search
     min_age : float
         Minimum number of days old to yield, by default 30
-    skip : str
-        If this string is found in the filename, the file will be skipped,
-        by default "delete"
+    skip : Union[str, Callable[[str], bool]]
+        If this string is found (case-insensitively) in the name of a file, the file
+        will be skipped.  If it is found in the name of a directory, the directory
+        and everything in it will be skipped.  Only entry *names* are checked, not
+        the full path (so it will not match, e.g., the name of `directory` itself).
+        May also be a function that takes an entry name and returns True to skip it.
+        By default "" (nothing is skipped).
+    cache : Optional[TreeCache]
+        If provided, will be populated with the metadata gathered during the walk,
+        for reuse by `iter_empty_dirs`.  Directory listings from a previous walk
+        (see `load_tree_cache`) are reused for directories that have not changed.
+    pool : Optional["Executor"]
+        If provided, file metadata is fetched concurrently using this executor.
+        Recommended for network shares.
+    strict_mtime : bool
+        If False, files in directories that have not been modified in more than
+        `min_age` days (plus a day of margin) are assumed to be as old as their
+        directory, and are not stat-ed individually.  Much faster on large, quiescent
+        network shares, but misses files that were rewritten in place.  By default,
+        True.
 
     Yields
     ------
-    Iterator[Path]
-        Paths to files that are greater than `min_age` days old.
+    Iterator[Tuple[str, float]]
+        Paths to files that are greater than `min_age` days old, and their age in
+        days.  (Paths are plain strings, to keep per-file overhead low on large
+        trees.)
     """
-    for path in Path(directory).glob("**/*"):
-        if path.is_file():
-            if skip and (skip.lower() in str(path).lower()):
+    for path, st in _scan_tree(directory, skip, cache, pool, min_age, strict_mtime):
+        if stat.S_ISREG(st.st_mode) and (days_old := _age(_timestamp(st))) > min_age:
+            yield path, days_old
+
+
+def iter_empty_dirs(
+    directory: Union[str, "Path"],
+    skip: Skip = "",
+    cache: Optional[TreeCache] = None,
+) -> Iterator[str]:
+    """Iterate over (paths to) empty directories nested arbitrarily deep in `directory`.
+
+    Directories are yielded deepest first, and each yielded directory is assumed to
+    be removed by the caller, so that a directory containing only empty directories
+    is yielded (after them) as well.  `skip` is interpreted as in `iter_old_files`.
+
+    If a `cache` populated by `iter_old_files` is provided, the tree is not walked
+    again: a directory is considered empty when every entry it contained has been
+    removed (as recorded with `TreeCache.mark_removed`).
+    """
+    if cache is not None:
+        yield from _iter_cached_empty_dirs(cache)
+        return
+
+    skipped = _skip_func(skip)
+    root = os.fspath(directory)
+    emptied: Set[str] = set()
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        if dirpath == root or filenames:
+            continue
+        if not all(os.path.join(dirpath, d) in emptied for d in dirnames):
+            continue
+        if skipped is not None:
+            rel = os.path.relpath(dirpath, root)
+            if any(skipped(part) for part in rel.split(os.sep)):
                 continue
-            last_mod = (TIME - path.stat().st_mtime) / SEC_PER_DAY
-            created = (TIME - path.stat().st_ctime) / SEC_PER_DAY
-            if (days_old := min(last_mod, created)) > min_age:
-                yield path, days_old
-
-
-def iter_empty_dirs(directory: Union[str, Path], skip: str = "") -> Iterator[Path]:
-    """Iterate over empty directories nested arbitrarily deep in `directory`."""
-    for path in Path(directory).glob("**/*"):
-        if (
-            path.is_dir()
-            and not list(path.iterdir())
-            and (not skip or skip.lower() not in str(path).lower())
-        ):
+        emptied.add(dirpath)
+        yield dirpath
+
+
+def _iter_cached_empty_dirs(cache: TreeCache) -> Iterator[str]:
+    remaining = dict(cache.n_entries)
+    dirs = [path for path in cache.dirs if path in remaining]
+    dirs.sort(key=lambda p: p.count(os.sep), reverse=True)
+    for path in dirs:
+        if remaining[path] == 0:
             yield path
+            parent = os.path.dirname(path)
+            if parent in remaining:
+                remaining[parent] -= 1
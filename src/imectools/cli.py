@@ -1,12 +1,52 @@
+import os
+import time
+from itertools import chain, islice
 from pathlib import Path
-from typing import Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import typer
+from typer.core import TyperGroup
 
 import imectools
 
-app = typer.Typer(no_args_is_help=True, add_completion=False)
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+
+class _MainGroup(TyperGroup):
+    """Group that only formats the version into the help text when it's shown.
+
+    (Looking up the version reads package metadata, which we'd rather not do on
+    every invocation.)
+    """
+
+    def format_help(self, ctx: Any, formatter: Any) -> None:
+        # restore the template afterwards, as the group may format its help again
+        template = self.help
+        self.help = typer.style(
+            (template or "").format(version=imectools.__version__), fg="bright_yellow"
+        )
+        try:
+            super().format_help(ctx, formatter)
+        finally:
+            self.help = template
+
+
+app = typer.Typer(no_args_is_help=True, add_completion=False, cls=_MainGroup)
 STATE = {"verbose": False}
+CACHE_DIR = Path.home() / ".cache" / "imectools"
+# threads used for metadata calls and deletions on network shares
+N_WORKERS = 32
 
 
 def _show_version_and_exit(value: bool) -> None:
@@ -31,21 +71,31 @@ def _main(
     """
 
 
-_main.__doc__ = typer.style(
-    (_main.__doc__ or "").format(version=imectools.__version__), fg="bright_yellow"
-)
-
-
 @app.command()
 def update() -> None:
     """Update imectools itself."""
-    import subprocess
-
     url = "https://github.com/tlambert03/imectools/archive/refs/heads/main.zip"
-    subprocess.run(
-        ["pip", "install", "--upgrade", "--force-reinstall", url],
-        stderr=subprocess.DEVNULL,
-    )
+    args = ["install", "--upgrade", "--force-reinstall", url]
+    try:
+        # run pip in this interpreter, rather than starting a new one
+        from pip._internal.cli.main import main as pip_main
+    except ImportError:
+        import subprocess
+
+        proc = subprocess.run(["pip", *args], stderr=subprocess.PIPE, text=True)
+        rc, stderr = proc.returncode, proc.stderr
+    else:
+        import contextlib
+        import io
+
+        with contextlib.redirect_stderr(io.StringIO()) as buf:
+            rc = pip_main(args)
+        stderr = buf.getvalue()
+
+    # pip's stderr is only worth showing if the update failed
+    if rc:
+        typer.secho(stderr, err=True, fg="red")
+        raise typer.Exit(rc)
 
 
 @app.command()
@@ -79,11 +129,39 @@ def clean(
         "the number of files that would be deleted)",
     ),
     delete_empty_dirs: bool = typer.Option(True, help="Delete empty directories."),
-    skip: str = typer.Option("delete", help="Don't delete files with this string."),
+    skip: str = typer.Option(
+        "delete",
+        help="Don't delete files (or directories) with this string in their name.",
+    ),
+    use_cache: bool = typer.Option(
+        True,
+        "--cache/--no-cache",
+        help="Remember directory listings between runs, so that directories that "
+        "have not changed since the last run are not listed again.",
+    ),
+    strict_mtime: bool = typer.Option(
+        True,
+        "--strict-mtime/--fast-mtime",
+        help="Check the age of every file (the default). With --fast-mtime, files "
+        "in directories that have not changed in DAYS (+1) days are assumed to be "
+        "at least as old as the directory, which is much faster on large shares, "
+        "but may delete files that were modified in place.",
+    ),
+    limit: int = typer.Option(
+        0,
+        "--limit",
+        min=0,
+        help="Stop after finding this many old files (0 for no limit). Useful for "
+        "cleaning very large shares in chunks.",
+    ),
 ) -> None:
     """✨ Delete files in a given directory older than a certain age."""
+    secho = typer.secho
     context = None
+    pool = None
     if directory.startswith("smb://"):
+        from concurrent.futures import ThreadPoolExecutor
+
         from imectools.remote import mount_smb
 
         server, *rest = directory[6:].split("/")
@@ -96,39 +174,63 @@ def clean(
 
         context = mount_smb(server, share, user)
         _directory = Path(context.__enter__())
-        typer.secho("loaded remote directory")
+        secho("loaded remote directory")
+        # every metadata call is a network round-trip: keep many in flight at once
+        pool = ThreadPoolExecutor(max_workers=N_WORKERS)
     else:
         _directory = Path(directory).resolve()
         if not _directory.is_dir():
             if _directory.exists():
-                typer.secho(f"Path is not a directory: {directory!r}", fg="red")
+                secho(f"Path is not a directory: {directory!r}", fg="red")
             else:
-                typer.secho(f"Directory does not exist: {directory!r}", fg="red")
+                secho(f"Directory does not exist: {directory!r}", fg="red")
             raise typer.Exit(0)
 
     print(f"cleaninig directory: {directory!r}")
+    cache_file = _cache_file(directory if context else str(_directory))
+    if use_cache:
+        tree = imectools.load_tree_cache(cache_file)
+    else:
+        tree = imectools.TreeCache()
     try:
-        # grab list of old files
-        old_files = list(imectools.iter_old_files(_directory, days, skip=skip))
+        # stream old files, caching the tree metadata for the empty-dirs pass
+        old_iter = imectools.iter_old_files(
+            _directory,
+            days,
+            skip=skip,
+            cache=tree,
+            pool=pool,
+            strict_mtime=strict_mtime,
+        )
+        if limit:
+            old_iter = islice(old_iter, limit)
 
         # if there are no old files, exit
-        if not old_files:
-            typer.secho(
+        first = next(old_iter, None)
+        if first is None:
+            secho(
                 f"No files found in {directory!r} older than {days} days!",
                 fg="green",
                 bold=True,
             )
             raise typer.Exit(0)
+        old_files: Iterable[Tuple[str, float]] = chain([first], old_iter)
 
         # if dry_run, just print what would be deleted
         if dry_run:
-            for old_file, age in old_files:
-                name_age = f"{old_file} ({age:.1f} days old)"
-                typer.secho(f"Would delete {name_age}", fg=(140, 140, 140))
+            n_found = 0
+            with _LinePrinter(fg=(140, 140, 140)) as would_delete:
+                for old_file, age in old_files:
+                    would_delete(f"Would delete {old_file} ({age:.1f} days old)")
+                    n_found += 1
+            if limit and n_found >= limit:
+                _warn_limit_reached(limit)
             raise typer.Exit(0)
 
         # if force was not specified, ask for confirmation
+        # (only in this case do we need to hold the full list of files in memory)
         if not force:
+            old_files = list(old_files)
             msg = typer.style(
                 f"This will delete {len(old_files)} files (use '--dry-run' to show them"
                 "). Are you sure?",
@@ -138,44 +240,201 @@ def clean(
             typer.confirm(msg, abort=True)
 
         # actually delete files
-        for old_file, age in old_files:
-            name_age = f"{old_file} ({age:.1f} days old)"
-            count = 0
-            errs = 0
-            try:
-                old_file.unlink()
-                typer.secho(f"Deleted {name_age}", fg="green")
-                count += 1
-            except Exception as e:
-                typer.secho(f"Failed to delete {name_age}: {e}", err=True, fg="red")
-                errs += 1
+        count = errs = 0
+        # (this output is the only record of what was deleted: the context manager
+        # writes pending lines even if the loop is interrupted)
+        with _LinePrinter(fg="green") as deleted:
+            for old_file, age, err in _unlink_all(old_files, pool, 2 * N_WORKERS):
+                name_age = f"{old_file} ({age:.1f} days old)"
+                if err is None:
+                    tree.mark_removed(old_file)
+                    deleted(f"Deleted {name_age}")
+                    count += 1
+                else:
+                    deleted.flush()
+                    secho(f"Failed to delete {name_age}: {err}", err=True, fg="red")
+                    errs += 1
 
         if delete_empty_dirs:
-            typer.secho("---------------------------------------", fg=(110, 110, 110))
-            for empty in imectools.iter_empty_dirs(_directory, skip=skip):
-                try:
-                    empty.rmdir()
-                    typer.secho(f"📂 Deleted empty directory {empty}", fg="green")
-                except Exception as e:
-                    typer.secho(
-                        f"Failed to delete empty directory {empty}: {e}",
+            secho("---------------------------------------", fg=(110, 110, 110))
+            empties = imectools.iter_empty_dirs(_directory, skip=skip, cache=tree)
+            for empty, err in _rmdir_all(empties, pool):
+                if err is None:
+                    secho(f"📂 Deleted empty directory {empty}", fg="green")
+                else:
+                    secho(
+                        f"Failed to delete empty directory {empty}: {err}",
                         err=True,
                         fg="red",
                     )
 
-        typer.secho("---------------------------------------", fg=(160, 160, 160))
+        secho("---------------------------------------", fg=(160, 160, 160))
 
         # print summary and exit
+        if limit and count + errs >= limit:
+            _warn_limit_reached(limit)
         if count:
-            typer.secho(f"Deleted {count} files", fg="green", bold=True)
+            secho(f"Deleted {count} files", fg="green", bold=True)
         if errs:
-            typer.secho(f"Unabled to delete {errs} files.", fg="red", bold=True)
+            secho(f"Unabled to delete {errs} files.", fg="red", bold=True)
         raise typer.Exit(1 if errs else 0)
     finally:
+        if use_cache:
+            try:
+                imectools.save_tree_cache(tree, cache_file)
+            except OSError as e:
+                secho(f"Failed to save cache {cache_file}: {e}", err=True, fg="red")
+        if pool:
+            pool.shutdown()
         if context:
             context.__exit__(None, None, None)
 
 
+def _warn_limit_reached(limit: int) -> None:
+    typer.secho(
+        f"Stopped at the --limit of {limit} files. There may be more old files "
+        "(if so, run again to continue).",
+        fg="yellow",
+        bold=True,
+    )
+
+
+class _LinePrinter:
+    """Print (many) lines in a single color to stdout, in chunks.
+
+    Equivalent to calling `typer.secho(line, fg=fg)` for each line, but the lines
+    are styled and written `chunk_size` at a time (or at least every `interval`
+    seconds), rather than one write per line.  Use as a context manager, so that
+    pending lines are written even if the loop printing them is interrupted.
+    """
+
+    def __init__(self, fg: Any, chunk_size: int = 1024, interval: float = 1) -> None:
+        self._chunk_size = chunk_size
+        self._interval = interval
+        self._lines: List[str] = []
+        self._last_flush = time.monotonic()
+        # (echo strips the styling again if stdout is not a terminal)
+        self._prefix, self._suffix = typer.style("\0", fg=fg).split("\0")
+
+    def __call__(self, line: str) -> None:
+        self._lines.append(f"{self._prefix}{line}{self._suffix}\n")
+        if (
+            len(self._lines) >= self._chunk_size
+            or time.monotonic() - self._last_flush >= self._interval
+        ):
+            self.flush()
+
+    def __enter__(self) -> "_LinePrinter":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.flush()
+
+    def flush(self) -> None:
+        if self._lines:
+            typer.echo("".join(self._lines), nl=False)
+            self._lines.clear()
+        self._last_flush = time.monotonic()
+
+
+def _cache_file(directory: str) -> Path:
+    """Return the path where the listings cache for `directory` is stored."""
+    from urllib.parse import quote
+
+    return CACHE_DIR / f"{quote(directory, safe='')}.pkl"
+
+
+def _unlink_all(
+    old_files: Iterable[Tuple[str, float]],
+    pool: "Optional[Executor]" = None,
+    max_pending: int = 64,
+) -> Iterator[Tuple[str, float, Optional[BaseException]]]:
+    """Delete `old_files`, yielding `(path, age, error)` as each deletion finishes.
+
+    If `pool` is provided, deletions are submitted to it and yielded in order of
+    completion, otherwise files are deleted one at a time.  At most `max_pending`
+    deletions are in flight at once, so `old_files` is consumed (and results are
+    yielded) as it streams in, rather than only once it is exhausted.
+    """
+    unlink = os.unlink
+    if pool is None:
+        for path, age in old_files:
+            try:
+                unlink(path)
+            except Exception as e:
+                yield path, age, e
+            else:
+                yield path, age, None
+        return
+
+    from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, wait
+
+    pending: Dict[Future, Tuple[str, float]] = {}
+
+    def _finished(return_when: str) -> Iterator[Tuple[str, float, Any]]:
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            path, age = pending.pop(future)
+            yield path, age, future.exception()
+
+    for path, age in old_files:
+        pending[pool.submit(unlink, path)] = (path, age)
+        if len(pending) >= max_pending:
+            yield from _finished(FIRST_COMPLETED)
+    yield from _finished(ALL_COMPLETED)
+
+
+def _rmdir_all(
+    empties: Iterable[str], pool: "Optional[Executor]" = None
+) -> Iterator[Tuple[str, Optional[BaseException]]]:
+    """Remove `empties`, yielding `(path, error)` as each removal finishes.
+
+    `empties` must be ordered deepest first (as yielded by `iter_empty_dirs`). If
+    `pool` is provided, directories at the same depth are removed concurrently, and
+    each depth is finished before moving up to the next one, so that parents are
+    only removed once their (empty) children are gone.
+
+    If a directory can't be removed, its parent is no longer empty: the parent (and
+    so on up the tree) is skipped, rather than reported as a second failure.
+    """
+    rmdir = os.rmdir
+    dirname = os.path.dirname
+    # parents of directories that could not be removed
+    blocked: Set[str] = set()
+
+    if pool is None:
+        for path in empties:
+            if path in blocked:
+                blocked.add(dirname(path))
+                continue
+            try:
+                rmdir(path)
+            except Exception as e:
+                blocked.add(dirname(path))
+                yield path, e
+            else:
+                yield path, None
+        return
+
+    from concurrent.futures import as_completed
+
+    by_depth: Dict[int, List[str]] = {}
+    for path in empties:
+        by_depth.setdefault(path.count(os.sep), []).append(path)
+    for depth in sorted(by_depth, reverse=True):
+        futures = {}
+        for path in by_depth[depth]:
+            if path in blocked:
+                blocked.add(dirname(path))
+            else:
+                futures[pool.submit(rmdir, path)] = path
+        for future in as_completed(futures):
+            path, err = futures[future], future.exception()
+            if err is not None:
+                blocked.add(dirname(path))
+            yield path, err
+
+
 @app.command()
 def clean_many(
     ip_file: Path = typer.Argument(
@@ -188,6 +447,26 @@ def clean_many(
         help="Delete without confirmation (otherwise a prompt is shown with "
         "the number of files that would be deleted)",
     ),
+    use_cache: bool = typer.Option(
+        True,
+        "--cache/--no-cache",
+        help="Remember directory listings between runs, so that directories that "
+        "have not changed since the last run are not listed again.",
+    ),
+    strict_mtime: bool = typer.Option(
+        True,
+        "--strict-mtime/--fast-mtime",
+        help="Check the age of every file (the default). With --fast-mtime, files "
+        "in directories that have not changed in 61 days are assumed to be at "
+        "least as old as the directory (see `imec clean --help`).",
+    ),
+    jobs: int = typer.Option(
+        8,
+        "-j",
+        "--jobs",
+        min=1,
+        help="Number of stations to clean concurrently.",
+    ),
 ) -> None:
     r"""Clean many directories at once from json file.
 
@@ -199,6 +478,7 @@ def clean_many(
     """
     import json
     from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
 
     if ip_file.suffix != ".json":
         raise typer.BadParameter("File must have .json extension")
@@ -206,23 +486,31 @@ def clean_many(
     with open(ip_file) as f:
         data = json.load(f)
 
-    with ThreadPoolExecutor(max_workers=8) as pool:
-        args = [
-            (f"smb://{ip}/data", 60, False, force, True, "delete")
-            for _, ip in data.items()
-            if ip is not None
-        ]
-        list(pool.map(_try_clean, args))
+    # (clean is called directly, so every option must be passed explicitly)
+    clean_station = partial(
+        _try_clean,
+        days=60,
+        dry_run=False,
+        force=force,
+        delete_empty_dirs=True,
+        skip="delete",
+        use_cache=use_cache,
+        strict_mtime=strict_mtime,
+        limit=0,
+    )
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        directories = [f"smb://{ip}/data" for _, ip in data.items() if ip is not None]
+        list(pool.map(clean_station, directories))
 
 
-def _try_clean(args: tuple) -> None:
+def _try_clean(directory: str, **kwargs: Any) -> None:
     """Wrap clean in a try catch for multithreading."""
     try:
-        clean(*args)
+        clean(directory, **kwargs)
     except Exception as e:
         if isinstance(e, typer.Exit) and e.exit_code == 0:
             return
-        typer.secho(f"Failed to clean {args[0]}: {e}", fg="red")
+        typer.secho(f"Failed to clean {directory}: {e}", fg="red")
 
 
 def main() -> None:
@@ -0,0 +1,237 @@
+import os
+import pickle
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+import imectools
+from imectools import _cleanup
+
+DAY = _cleanup.SEC_PER_DAY
+# pretend "now" is far in the future, so that everything on disk is (by ctime)
+# 1000 days old, and ages can be lowered as needed with `_set_age`.
+NOW = time.time() + 1000 * DAY
+
+
+@pytest.fixture(autouse=True)
+def _fake_now(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(_cleanup, "TIME", NOW)
+
+
+def _set_age(path: Path, days: float) -> None:
+    stamp = NOW - days * DAY
+    os.utime(path, (stamp, stamp))
+
+
+def _make(root: Path, *names: str) -> None:
+    """Create files (or directories, if the name ends with '/') under root."""
+    for name in names:
+        path = root / name
+        if name.endswith("/"):
+            path.mkdir(parents=True, exist_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+
+
+def _clean(root: Path, **kwargs: object) -> "list[str]":
+    """Delete old files (like `imec clean`), then return the empty dirs found."""
+    tree = imectools.TreeCache()
+    for path, _ in imectools.iter_old_files(root, 30, cache=tree, **kwargs):
+        os.unlink(path)
+        tree.mark_removed(path)
+    return list(imectools.iter_empty_dirs(root, cache=tree))
+
+
+def test_cached_empty_dirs_cascade(tmp_path: Path) -> None:
+    _make(tmp_path, "a/b/c/", "a/b/old.txt", "d/new.txt")
+    _set_age(tmp_path / "d" / "new.txt", 1)
+
+    empties = _clean(tmp_path)
+    assert empties == [
+        str(tmp_path / "a" / "b" / "c"),
+        str(tmp_path / "a" / "b"),
+        str(tmp_path / "a"),
+    ]
+
+
+def test_cached_empty_dirs_skipped_entries_keep_parent(tmp_path: Path) -> None:
+    _make(tmp_path, "a/old.txt", "a/delete-me.txt", "b/old.txt", "b/DELETE/")
+
+    tree = imectools.TreeCache()
+    removed = []
+    for path, _ in imectools.iter_old_files(tmp_path, 30, "delete", cache=tree):
+        os.unlink(path)
+        tree.mark_removed(path)
+        removed.append(path)
+    assert sorted(removed) == [str(tmp_path / "a/old.txt"), str(tmp_path / "b/old.txt")]
+    assert not list(imectools.iter_empty_dirs(tmp_path, cache=tree))
+
+
+def test_cached_empty_dirs_partial_removal(tmp_path: Path) -> None:
+    _make(tmp_path, "a/one.txt", "a/two.txt", "b/three.txt")
+
+    tree = imectools.TreeCache()
+    old = sorted(p for p, _ in imectools.iter_old_files(tmp_path, 30, cache=tree))
+    assert len(old) == 3
+    removed = [str(tmp_path / "a/one.txt"), str(tmp_path / "b/three.txt")]
+    for path in removed:
+        os.unlink(path)
+        tree.mark_removed(path)
+    empties = list(imectools.iter_empty_dirs(tmp_path, cache=tree))
+    assert empties == [str(tmp_path / "b")]
+
+
+def test_uncached_empty_dirs(tmp_path: Path) -> None:
+    _make(tmp_path, "a/b/", "c/file.txt", "delete/x/")
+    empties = list(imectools.iter_empty_dirs(tmp_path, skip="delete"))
+    assert empties == [str(tmp_path / "a" / "b"), str(tmp_path / "a")]
+
+
+def _walk(root: Path, cache_file: Path) -> List[str]:
+    """Find old files, reusing (and then saving) the listings in `cache_file`."""
+    tree = imectools.load_tree_cache(cache_file)
+    old = sorted(p for p, _ in imectools.iter_old_files(root, 30, cache=tree))
+    imectools.save_tree_cache(tree, cache_file)
+    return old
+
+
+@pytest.fixture
+def calls(monkeypatch: pytest.MonkeyPatch) -> Dict[str, List[str]]:
+    """Record the paths passed to os.scandir and os.lstat."""
+    calls: Dict[str, List[str]] = {"scandir": [], "lstat": []}
+    for name in calls:
+        real = getattr(os, name)
+
+        def _wrapper(path: str, _real=real, _name=name):  # type: ignore
+            calls[_name].append(os.fspath(path))
+            return _real(path)
+
+        monkeypatch.setattr(os, name, _wrapper)
+    return calls
+
+
+def test_listing_cache_reused(tmp_path: Path, calls: dict) -> None:
+    root = tmp_path / "data"
+    _make(root, "a/old.txt", "a/new.txt", "b/")
+    _set_age(root / "a" / "new.txt", 1)
+    cache_file = tmp_path / "cache.pkl"
+
+    assert _walk(root, cache_file) == [str(root / "a" / "old.txt")]
+    assert len(calls["scandir"]) == 3
+
+    calls["scandir"].clear()
+    assert _walk(root, cache_file) == [str(root / "a" / "old.txt")]
+    # nothing changed: no directory is listed again, and the young file (which
+    # can only have gotten younger) is not stat-ed again
+    assert calls["scandir"] == []
+    assert str(root / "a" / "new.txt") not in calls["lstat"]
+    # ... but the old file (which may have been rewritten) is
+    assert str(root / "a" / "old.txt") in calls["lstat"]
+
+
+def test_listing_cache_file_rewritten_in_place(tmp_path: Path) -> None:
+    root = tmp_path / "data"
+    _make(root, "a/old.txt")
+    _set_age(root / "a", 1)
+    cache_file = tmp_path / "cache.pkl"
+    assert _walk(root, cache_file) == [str(root / "a" / "old.txt")]
+
+    # rewriting a file does not change its directory's mtime
+    mtime = os.stat(root / "a").st_mtime
+    _set_age(root / "a" / "old.txt", 1)
+    assert os.stat(root / "a").st_mtime == mtime
+    assert _walk(root, cache_file) == []
+
+
+def test_listing_cache_stale_directory(tmp_path: Path) -> None:
+    root = tmp_path / "data"
+    _make(root, "a/one.txt")
+    cache_file = tmp_path / "cache.pkl"
+    assert _walk(root, cache_file) == [str(root / "a" / "one.txt")]
+
+    # a new entry changes the directory's mtime, so it is listed again
+    _make(root, "a/two.txt")
+    assert _walk(root, cache_file) == [
+        str(root / "a" / "one.txt"),
+        str(root / "a" / "two.txt"),
+    ]
+
+
+@pytest.mark.parametrize("content", [b"not a pickle", pickle.dumps([1, 2, 3])])
+def test_corrupt_listing_cache_ignored(tmp_path: Path, content: bytes) -> None:
+    root = tmp_path / "data"
+    _make(root, "a/old.txt")
+    cache_file = tmp_path / "cache.pkl"
+    cache_file.write_bytes(content)
+
+    assert imectools.load_tree_cache(cache_file).listings == {}
+    assert _walk(root, cache_file) == [str(root / "a" / "old.txt")]
+    assert imectools.load_tree_cache(cache_file).listings
+
+
+def _old(root: Path, **kwargs: object) -> Dict[str, float]:
+    """Return {name: days_old} for the files older than 30 days in root."""
+    old = imectools.iter_old_files(root, 30, **kwargs)  # type: ignore
+    return {os.path.relpath(p, root): round(age) for p, age in old}
+
+
+@pytest.mark.parametrize("strict", [True, False])
+def test_strict_mtime_file_rewritten_in_place(tmp_path: Path, strict: bool) -> None:
+    _make(tmp_path, "a/old.txt", "a/new.txt")
+    _set_age(tmp_path / "a" / "old.txt", 500)
+    # rewriting a file in place does not touch its (otherwise quiescent) directory
+    _set_age(tmp_path / "a" / "new.txt", 1)
+    _set_age(tmp_path / "a", 100)
+
+    if strict:
+        assert _old(tmp_path, strict_mtime=True) == {"a/old.txt": 500}
+    else:
+        # fast mode takes every file's age from the directory, and cannot tell
+        assert _old(tmp_path, strict_mtime=False) == {
+            "a/old.txt": 100,
+            "a/new.txt": 100,
+        }
+
+
+def test_fast_mtime_non_quiescent_directory(tmp_path: Path) -> None:
+    _make(tmp_path, "a/old.txt", "a/new.txt")
+    _set_age(tmp_path / "a" / "old.txt", 500)
+    _set_age(tmp_path / "a" / "new.txt", 1)
+    # the directory changed recently, so its files must be checked one by one
+    _set_age(tmp_path / "a", 10)
+
+    assert _old(tmp_path, strict_mtime=False) == {"a/old.txt": 500}
+
+
+def test_fast_mtime_prefers_cached_timestamp(tmp_path: Path) -> None:
+    _make(tmp_path, "a/old.txt", "a/new.txt")
+    _set_age(tmp_path / "a" / "new.txt", 1)
+    _set_age(tmp_path / "a", 100)
+    tree = imectools.TreeCache(listings={})
+    assert _old(tmp_path, cache=tree) == {"a/old.txt": 1000}
+
+    # the young file was recorded by the strict walk, and is not aged by the
+    # directory on a later fast walk
+    tree = imectools.TreeCache(listings=tree.listings)
+    assert _old(tmp_path, cache=tree, strict_mtime=False) == {"a/old.txt": 100}
+
+
+def test_stat_batches_split_large_directories(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(_cleanup, "STAT_BATCH", 3)
+    _make(tmp_path, *(f"a/{i}.txt" for i in range(10)), "b/old.txt")
+    sizes = []
+
+    class _Pool:
+        def map(self, func, items):  # type: ignore
+            sizes.append(len(items))
+            return map(func, items)
+
+    old = imectools.iter_old_files(tmp_path, 30, pool=_Pool())  # type: ignore
+    assert len(list(old)) == 11
+    assert sum(sizes) == 13  # (including the two directories)
+    assert max(sizes) == 3
@@ -0,0 +1,333 @@
+import inspect
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator, List, Tuple
+
+import pytest
+import typer
+from typer.testing import CliRunner
+
+import imectools
+from imectools import _cleanup, cli
+from imectools.cli import _rmdir_all, _unlink_all
+
+runner = CliRunner()
+NOW = time.time() + 1000 * _cleanup.SEC_PER_DAY
+
+
+def _files(root: Path, n: int) -> List[Tuple[str, float]]:
+    files = []
+    for i in range(n):
+        path = root / f"{i}.txt"
+        path.touch()
+        files.append((str(path), float(i)))
+    return files
+
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_unlink_all(tmp_path: Path, workers: int) -> None:
+    files = _files(tmp_path, 10)
+    missing = (str(tmp_path / "missing.txt"), 99.0)
+    pool = ThreadPoolExecutor(workers) if workers else None
+    try:
+        results = list(_unlink_all([*files, missing], pool))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    assert sorted(r[:2] for r in results if r[2] is None) == sorted(files)
+    errors = [r for r in results if r[2] is not None]
+    assert len(errors) == 1
+    assert errors[0][:2] == missing
+    assert isinstance(errors[0][2], FileNotFoundError)
+    assert not list(tmp_path.iterdir())
+
+
+def test_unlink_all_streams(tmp_path: Path) -> None:
+    files = _files(tmp_path, 20)
+    consumed = 0
+
+    def _stream() -> Iterator[Tuple[str, float]]:
+        nonlocal consumed
+        for item in files:
+            consumed += 1
+            yield item
+
+    with ThreadPoolExecutor(2) as pool:
+        results = _unlink_all(_stream(), pool, max_pending=4)
+        first = next(results)
+        # deletions start (and are reported) before the input is exhausted
+        assert consumed <= 4
+        assert len([first, *results]) == 20
+
+
+@pytest.fixture
+def tree(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A directory with two old files (one nested), and one young file."""
+    monkeypatch.setattr(_cleanup, "TIME", NOW)
+    monkeypatch.setattr(cli, "CACHE_DIR", tmp_path / "cache")
+    root = tmp_path / "data"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "a" / "b" / "old.txt").touch()
+    (root / "old.txt").touch()
+    (root / "new.txt").touch()
+    young = NOW - 5 * _cleanup.SEC_PER_DAY
+    os.utime(root / "new.txt", (young, young))
+    os.utime(root, (young, young))
+    return root
+
+
+def _remaining(root: Path) -> List[str]:
+    return sorted(str(p.relative_to(root)) for p in root.rglob("*"))
+
+
+def test_clean_nothing_to_delete(tree: Path) -> None:
+    result = runner.invoke(cli.app, ["clean", str(tree), "-d", "2000"])
+    assert result.exit_code == 0
+    assert "No files found" in result.output
+    assert _remaining(tree) == ["a", "a/b", "a/b/old.txt", "new.txt", "old.txt"]
+
+
+def test_clean_dry_run(tree: Path) -> None:
+    result = runner.invoke(cli.app, ["clean", str(tree), "-d", "30", "--dry-run"])
+    assert result.exit_code == 0
+    assert result.output.count("Would delete") == 2
+    assert f"Would delete {tree / 'old.txt'} (1000.0 days old)" in result.output
+    assert len(_remaining(tree)) == 5
+
+
+def test_clean_force(tree: Path) -> None:
+    result = runner.invoke(cli.app, ["clean", str(tree), "-d", "30", "--force"])
+    assert result.exit_code == 0
+    assert "Deleted 2 files" in result.output
+    assert _remaining(tree) == ["new.txt"]
+
+
+def test_clean_confirm(tree: Path) -> None:
+    result = runner.invoke(cli.app, ["clean", str(tree), "-d", "30"], input="n\n")
+    assert result.exit_code == 1
+    assert "This will delete 2 files" in result.output
+    assert len(_remaining(tree)) == 5
+
+
+def test_clean_cache(tree: Path) -> None:
+    args = ["clean", str(tree), "-d", "30", "--dry-run"]
+    result = runner.invoke(cli.app, [*args, "--no-cache"])
+    assert result.exit_code == 0
+    assert not (tree.parent / "cache").exists()
+
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert len(list((tree.parent / "cache").glob("*.pkl"))) == 1
+
+
+def test_clean_many_forwards_options(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    params = inspect.signature(cli.clean).parameters
+    calls = []
+    monkeypatch.setattr(cli, "clean", lambda *a, **kw: calls.append((a, kw)))
+    ip_file = tmp_path / "ips.json"
+    ip_file.write_text('{"station1": "10.0.0.1", "station2": "10.0.0.2"}')
+
+    result = runner.invoke(cli.app, ["clean-many", str(ip_file), "-f", "--no-cache"])
+    assert result.exit_code == 0
+    assert sorted(a for a, _ in calls) == [
+        ("smb://10.0.0.1/data",),
+        ("smb://10.0.0.2/data",),
+    ]
+    # every option of `clean` (other than the directory) is passed by name
+    for _, kwargs in calls:
+        assert set(kwargs) == set(params) - {"directory"}
+        assert kwargs["force"] is True
+        assert kwargs["use_cache"] is False
+
+
+def test_clean_strict_mtime_by_default(tree: Path) -> None:
+    # a quiescent root: its files *look* old, but new.txt was rewritten in place
+    old = NOW - 100 * _cleanup.SEC_PER_DAY
+    os.utime(tree, (old, old))
+    args = ["clean", str(tree), "-d", "30", "--dry-run", "--no-cache"]
+
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert result.output.count("Would delete") == 2
+
+    result = runner.invoke(cli.app, [*args, "--fast-mtime"])
+    assert result.exit_code == 0
+    assert result.output.count("Would delete") == 3
+
+
+def test_help_shows_version(capsys: pytest.CaptureFixture) -> None:
+    group = typer.main.get_command(cli.app)
+    template = group.help
+    for _ in range(2):
+        with pytest.raises(SystemExit):
+            group.main(["--help"], prog_name="imec")
+        assert f"v{imectools.__version__}" in capsys.readouterr().out
+        # the help template is left intact for the next call
+        assert group.help == template
+
+
+def _dirs(root: Path, *names: str) -> List[str]:
+    """Create (nested) directories under root, returning them deepest first."""
+    paths = [root / name for name in names]
+    for path in paths:
+        path.mkdir(parents=True, exist_ok=True)
+    return sorted({str(p) for p in paths}, key=lambda p: -p.count(os.sep))
+
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_rmdir_all_deepest_first(tmp_path: Path, workers: int) -> None:
+    names = ["a", "a/b", "a/b/c", "a/b/c/d", "a/e", "a/e/f", "g"]
+    empties = _dirs(tmp_path, *names)
+    pool = ThreadPoolExecutor(workers) if workers else None
+    try:
+        results = list(_rmdir_all(empties, pool))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # each directory is only removed once its children are gone
+    assert [err for _, err in results] == [None] * len(names)
+    depths = [path.count(os.sep) for path, _ in results]
+    assert depths == sorted(depths, reverse=True)
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_rmdir_all_skips_parents_of_failures(tmp_path: Path, workers: int) -> None:
+    empties = _dirs(tmp_path, "a/b/c", "a/b", "a", "d")
+    # c is no longer empty (e.g. a file was written after the walk)
+    (tmp_path / "a" / "b" / "c" / "file.txt").touch()
+    pool = ThreadPoolExecutor(workers) if workers else None
+    try:
+        results = dict(_rmdir_all(empties, pool))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # a and b are not tried (and don't report an error of their own)
+    assert set(results) == {str(tmp_path / "a/b/c"), str(tmp_path / "d")}
+    assert isinstance(results[str(tmp_path / "a/b/c")], OSError)
+    assert results[str(tmp_path / "d")] is None
+    assert _remaining(tmp_path) == ["a", "a/b", "a/b/c", "a/b/c/file.txt"]
+
+
+def test_line_printer(capsys: pytest.CaptureFixture) -> None:
+    with cli._LinePrinter(fg="green", chunk_size=2, interval=60) as printer:
+        printer("one")
+        assert capsys.readouterr().out == ""
+        printer("two")
+        # styling is stripped, as stdout is not a terminal
+        assert capsys.readouterr().out == "one\ntwo\n"
+        printer("three")
+    assert capsys.readouterr().out == "three\n"
+
+
+def test_clean_interrupted_reports_deleted(
+    tree: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    def _unlink_then_fail(old_files, *_):  # type: ignore
+        for path, age in old_files:
+            os.unlink(path)
+            yield path, age, None
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(cli, "_unlink_all", _unlink_then_fail)
+    result = runner.invoke(cli.app, ["clean", str(tree), "-d", "30", "--force"])
+    assert isinstance(result.exception, RuntimeError)
+    # files that were really deleted are still reported
+    assert result.output.count("Deleted") == 2
+
+
+@pytest.fixture
+def nested(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """A directory holding only a subdirectory with three old files."""
+    monkeypatch.setattr(_cleanup, "TIME", NOW)
+    monkeypatch.setattr(cli, "CACHE_DIR", tmp_path / "cache")
+    root = tmp_path / "data"
+    (root / "x").mkdir(parents=True)
+    for i in range(3):
+        (root / "x" / f"{i}.txt").touch()
+    return root
+
+
+def test_clean_limit_dry_run(nested: Path) -> None:
+    args = ["clean", str(nested), "-d", "30", "--dry-run", "--limit", "2"]
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert result.output.count("Would delete") == 2
+    assert "Stopped at the --limit of 2 files" in result.output
+    assert len(_remaining(nested)) == 4
+
+
+def test_clean_limit_force(nested: Path) -> None:
+    args = ["clean", str(nested), "-d", "30", "--force", "--limit", "2"]
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert "Deleted 2 files" in result.output
+    assert "Stopped at the --limit of 2 files" in result.output
+    # the walk stopped before reaching the last file: x must not be treated as empty
+    assert "empty directory" not in result.output
+    assert len(_remaining(nested)) == 2
+    assert _remaining(nested)[0] == "x"
+
+
+def test_clean_limit_exactly_reached(nested: Path) -> None:
+    args = ["clean", str(nested), "-d", "30", "--force", "--limit", "3"]
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert "Deleted 3 files" in result.output
+    # (whether more old files exist is unknown without walking further)
+    assert "There may be more old files" in result.output
+    # all of x's entries were seen and removed, so x is removed too
+    assert f"Deleted empty directory {nested / 'x'}" in result.output
+    assert _remaining(nested) == []
+
+
+def test_clean_below_limit(nested: Path) -> None:
+    args = ["clean", str(nested), "-d", "30", "--force", "--limit", "4"]
+    result = runner.invoke(cli.app, args)
+    assert result.exit_code == 0
+    assert "--limit" not in result.output
+    assert _remaining(nested) == []
+
+
+@pytest.mark.parametrize("rc", [0, 1])
+def test_update(monkeypatch: pytest.MonkeyPatch, rc: int) -> None:
+    pip_main = pytest.importorskip("pip._internal.cli.main")
+    calls = []
+
+    def _main(args: List[str]) -> int:
+        calls.append(args)
+        print("ERROR: could not install" if rc else "WARNING: ok", file=sys.stderr)
+        return rc
+
+    monkeypatch.setattr(pip_main, "main", _main)
+    result = runner.invoke(cli.app, ["update"])
+    assert result.exit_code == rc
+    assert calls and calls[0][:2] == ["install", "--upgrade"]
+    # pip's stderr is only shown if the update failed
+    assert ("could not install" in result.output) == bool(rc)
+    assert "WARNING" not in result.output
+
+
+@pytest.mark.parametrize("rc", [0, 2])
+def test_update_without_pip_module(monkeypatch: pytest.MonkeyPatch, rc: int) -> None:
+    calls = []
+
+    def _run(args: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
+        calls.append(args)
+        return subprocess.CompletedProcess(args, rc, stderr="ERROR: no network")
+
+    monkeypatch.setitem(sys.modules, "pip._internal.cli.main", None)
+    monkeypatch.setattr(subprocess, "run", _run)
+    result = runner.invoke(cli.app, ["update"])
+    assert result.exit_code == rc
+    assert calls and calls[0][:2] == ["pip", "install"]
+    assert ("no network" in result.output) == bool(rc)